@@ -9,6 +9,8 @@ Sits between Open WebUI and Azure AI Foundry.
 """
 
 import os
+import asyncio
+import hmac
 import re
 import json
 import time
@@ -16,10 +18,26 @@ import logging
 import httpx
 import yaml
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from azure.identity.aio import ManagedIdentityCredential, DefaultAzureCredential
 
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:  # Fall back to stdlib json
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:  # libyaml not available
+    from yaml import SafeLoader as _YamlLoader
+
 # ---------------------------------------------------------------------------
 # Logging
 # ---------------------------------------------------------------------------
@@ -37,6 +55,7 @@ EXPECTED_API_KEY = os.getenv("EXPECTED_API_KEY", "")
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "120"))
 USE_MANAGED_IDENTITY = os.getenv("USE_MANAGED_IDENTITY", "true").lower() == "true"
 COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+_EXPECTED_API_KEY_BYTES = EXPECTED_API_KEY.encode()
 
 
 def load_config() -> dict:
@@ -54,16 +73,30 @@ def load_config() -> dict:
             }
         }
     with open(CONFIG_PATH) as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=_YamlLoader)
+
+
+def prepare_models(models: dict) -> dict:
+    """Precompute each model's Foundry URL and warn about missing endpoints."""
+    for model_id, cfg in models.items():
+        endpoint = cfg.get("endpoint") or ""
+        if not endpoint:
+            logger.warning(f"Model '{model_id}' has no endpoint configured")
+            continue
+        cfg["_url"] = f"{endpoint.rstrip('/')}/chat/completions"
+    return models
 
 
 CONFIG = load_config()
-MODELS = CONFIG.get("models", {})
+MODELS = prepare_models(CONFIG.get("models", {}))
 
 # ---------------------------------------------------------------------------
 # Entra credential (module-level, reused across requests)
 # ---------------------------------------------------------------------------
 _credential = None
+_token_cache: dict[str, tuple[str, int]] = {}  # scope -> (token, expires_on)
+_token_lock = asyncio.Lock()
+TOKEN_REFRESH_MARGIN = 300  # Refresh this many seconds before expiry
 
 
 async def get_credential():
@@ -77,37 +110,96 @@ async def get_credential():
     return _credential
 
 
+def _cached_token(scope: str) -> str | None:
+    cached = _token_cache.get(scope)
+    if cached and cached[1] - time.time() > TOKEN_REFRESH_MARGIN:
+        return cached[0]
+    return None
+
+
 async def get_entra_token() -> str:
-    """Acquire a Bearer token for Cognitive Services."""
-    cred = await get_credential()
-    token = await cred.get_token(COGNITIVE_SERVICES_SCOPE)
-    return token.token
+    """Acquire a Bearer token for Cognitive Services, cached until near expiry."""
+    token = _cached_token(COGNITIVE_SERVICES_SCOPE)
+    if token:
+        return token
+    async with _token_lock:
+        # Another request may have refreshed while we waited
+        token = _cached_token(COGNITIVE_SERVICES_SCOPE)
+        if token:
+            return token
+        cred = await get_credential()
+        access = await cred.get_token(COGNITIVE_SERVICES_SCOPE)
+        _token_cache[COGNITIVE_SERVICES_SCOPE] = (access.token, access.expires_on)
+        return access.token
 
 
 # ---------------------------------------------------------------------------
-# Auth dependency
+# Auth middleware
 # ---------------------------------------------------------------------------
-async def verify_api_key(request: Request):
-    if not EXPECTED_API_KEY:
-        raise HTTPException(500, "EXPECTED_API_KEY not configured on proxy")
-    auth = request.headers.get("Authorization", "")
-    if not auth.startswith("Bearer "):
-        raise HTTPException(401, "Missing Bearer token")
-    if auth[7:] != EXPECTED_API_KEY:
-        raise HTTPException(403, "Invalid API key")
+def check_api_key(headers: list[tuple[bytes, bytes]]) -> tuple[int, str] | None:
+    """Validate raw ASGI headers; return (status, detail) on failure."""
+    if not _EXPECTED_API_KEY_BYTES:
+        return 500, "EXPECTED_API_KEY not configured on proxy"
+    auth = b""
+    for name, value in headers:
+        if name == b"authorization":
+            auth = value
+            break
+    if not auth.startswith(b"Bearer "):
+        return 401, "Missing Bearer token"
+    if not hmac.compare_digest(auth[7:], _EXPECTED_API_KEY_BYTES):
+        return 403, "Invalid API key"
+    return None
+
+
+class AuthMiddleware:
+    """
+    Pure ASGI middleware enforcing the proxy API key on /v1/ routes.
+
+    Reads the Authorization header straight from the ASGI scope and
+    rejects the request before routing, skipping dependency injection.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/v1/"):
+            error = check_api_key(scope["headers"])
+            if error:
+                status, detail = error
+                response = JSONResponse({"detail": detail}, status_code=status)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
 
 
 # ---------------------------------------------------------------------------
 # CoT filtering
 # ---------------------------------------------------------------------------
-THINK_PATTERN = re.compile(r"<think>.*?</think>", re.DOTALL)
+_NEWLINE_COLLAPSE = re.compile(r"\n{3,}")
+_THINK_OPEN = "<think>"
+_THINK_CLOSE = "</think>"
 
 
 def strip_think_tags(text: str) -> str:
     """Remove <think>...</think> blocks and clean up whitespace."""
-    cleaned = THINK_PATTERN.sub("", text)
+    if _THINK_OPEN not in text:
+        return text
+    parts = []
+    while True:
+        before, tag, rest = text.partition(_THINK_OPEN)
+        parts.append(before)
+        if not tag:
+            break
+        _, close, text = rest.partition(_THINK_CLOSE)
+        if not close:
+            # Unterminated block — leave it in place
+            parts.append(tag)
+            parts.append(rest)
+            break
     # Collapse multiple newlines left behind
-    cleaned = re.sub(r"\n{3,}", "\n\n", cleaned)
+    cleaned = _NEWLINE_COLLAPSE.sub("\n\n", "".join(parts))
     return cleaned.strip()
 
 
@@ -115,73 +207,82 @@ class StreamingThinkFilter:
     """
     State machine that filters <think>...</think> from an SSE byte stream.
 
-    Buffers content when inside think tags, emits everything else immediately.
-    This avoids the user seeing partial reasoning tokens.
+    Scans each chunk with str.partition rather than char by char. Only a
+    trailing partial tag (e.g. "<thi") is carried over to the next chunk,
+    so everything else is emitted immediately and the user never sees
+    partial reasoning tokens.
     """
 
     def __init__(self):
         self.inside_think = False
-        self.buffer = ""
-        self.tag_buffer = ""  # For partial tag detection
+        self.carry = ""  # Trailing partial tag from the previous chunk
 
     def process_text(self, text: str) -> str:
         """Process a chunk of text, returning only the non-think content."""
+        if not self.carry and not self.inside_think and "<" not in text:
+            return text
+        buf = self.carry + text if self.carry else text
+        self.carry = ""
         output = []
-        i = 0
-        while i < len(text):
+        while buf:
             if not self.inside_think:
-                # Look for opening <think> tag
-                if text[i] == "<":
-                    # Buffer potential tag
-                    self.tag_buffer += text[i]
-                    i += 1
-                    continue
-                elif self.tag_buffer:
-                    # We're accumulating a potential tag
-                    self.tag_buffer += text[i]
-                    if self.tag_buffer == "<think>":
-                        self.inside_think = True
-                        self.tag_buffer = ""
-                    elif not "<think>".startswith(self.tag_buffer):
-                        # Not a think tag, flush the buffer
-                        output.append(self.tag_buffer)
-                        self.tag_buffer = ""
-                    i += 1
-                    continue
-                else:
-                    output.append(text[i])
-                    i += 1
+                before, tag, buf = buf.partition(_THINK_OPEN)
+                if not tag:
+                    # No opening tag — hold back a possible split tag
+                    keep = _partial_tag_len(before, _THINK_OPEN)
+                    if keep:
+                        self.carry = before[-keep:]
+                        before = before[:-keep]
+                    output.append(before)
+                    break
+                output.append(before)
+                self.inside_think = True
             else:
-                # Inside think block — look for closing </think>
-                if text[i] == "<":
-                    self.tag_buffer += text[i]
-                    i += 1
-                    continue
-                elif self.tag_buffer:
-                    self.tag_buffer += text[i]
-                    if self.tag_buffer == "</think>":
-                        self.inside_think = False
-                        self.tag_buffer = ""
-                    elif not "</think>".startswith(self.tag_buffer):
-                        # Not the closing tag, discard (we're inside think)
-                        self.tag_buffer = ""
-                    i += 1
-                    continue
-                else:
-                    # Discard think content
-                    i += 1
+                # Inside think block — discard up to the closing </think>
+                _, tag, rest = buf.partition(_THINK_CLOSE)
+                if not tag:
+                    keep = _partial_tag_len(buf, _THINK_CLOSE)
+                    if keep:
+                        self.carry = buf[-keep:]
+                    break
+                self.inside_think = False
+                buf = rest
 
         return "".join(output)
 
+    def passes_through(self, raw: bytes) -> bool:
+        """
+        Whether a raw upstream JSON frame can be forwarded untouched.
+
+        True when no tag is open or half-read and the frame holds no "<"
+        (literal or JSON-escaped), so it cannot start a think block.
+        """
+        return (
+            not self.inside_think
+            and not self.carry
+            and b"<" not in raw
+            and b"\\u003c" not in raw
+            and b"\\u003C" not in raw
+        )
+
     def flush(self) -> str:
         """Flush any remaining buffered content."""
-        if self.tag_buffer and not self.inside_think:
-            result = self.tag_buffer
-            self.tag_buffer = ""
+        if self.carry and not self.inside_think:
+            result = self.carry
+            self.carry = ""
             return result
         return ""
 
 
+def _partial_tag_len(text: str, tag: str) -> int:
+    """Length of the longest suffix of `text` that is a proper prefix of `tag`."""
+    # Tags contain a single "<", so a split tag can only start at the last one
+    start = text.rfind("<", max(len(text) - len(tag) + 1, 0))
+    if start != -1 and tag.startswith(text[start:]):
+        return len(text) - start
+    return 0
+
+
 # ---------------------------------------------------------------------------
 # Lifespan
 # ---------------------------------------------------------------------------
@@ -198,13 +299,22 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.warning(f"Could not acquire token on startup (may work later): {e}")
 
+    # Shared upstream client — keeps TLS connections to Foundry alive
+    app.state.http = httpx.AsyncClient(
+        timeout=REQUEST_TIMEOUT,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=256),
+    )
+
     yield
 
     # Cleanup
+    await app.state.http.aclose()
     global _credential
     if _credential:
         await _credential.close()
         _credential = None
+    _token_cache.clear()
     logger.info("Foundry proxy shut down")
 
 
@@ -212,32 +322,42 @@ async def lifespan(app: FastAPI):
 # FastAPI app
 # ---------------------------------------------------------------------------
 app = FastAPI(title="Foundry MaaS Proxy", lifespan=lifespan)
+app.add_middleware(AuthMiddleware)
 
 
 # ---------------------------------------------------------------------------
 # Routes
 # ---------------------------------------------------------------------------
+# MODELS is fixed after startup, so these payloads are serialized once
+_HEALTH_BODY = _json_dumps({"status": "ok", "models": list(MODELS.keys())})
+_MODELS_BODY = _json_dumps(
+    {
+        "object": "list",
+        "data": [
+            {
+                "id": model_id,
+                "object": "model",
+                "created": 0,
+                "owned_by": "azure-foundry",
+            }
+            for model_id in MODELS
+        ],
+    }
+)
+
+
 @app.get("/health")
 async def health():
-    return {"status": "ok", "models": list(MODELS.keys())}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 
-@app.get("/v1/models", dependencies=[Depends(verify_api_key)])
+@app.get("/v1/models")
 async def list_models():
     """OpenAI-compatible model listing."""
-    model_list = [
-        {
-            "id": model_id,
-            "object": "model",
-            "created": 0,
-            "owned_by": "azure-foundry",
-        }
-        for model_id in MODELS
-    ]
-    return {"object": "list", "data": model_list}
+    return Response(content=_MODELS_BODY, media_type="application/json")
 
 
-@app.post("/v1/chat/completions", dependencies=[Depends(verify_api_key)])
+@app.post("/v1/chat/completions")
 async def chat_completions(request: Request):
     """
     OpenAI-compatible chat completions endpoint.
@@ -245,7 +365,10 @@ async def chat_completions(request: Request):
     Accepts standard OpenAI request body, routes to the correct Foundry
     deployment, handles Entra auth, filters CoT, and streams back.
     """
-    body = await request.json()
+    try:
+        body = _json_loads(await request.body())
+    except ValueError:
+        raise HTTPException(400, "Request body is not valid JSON")
     model_id = body.get("model", "")
     wants_stream = body.get("stream", False)
 
@@ -257,7 +380,10 @@ async def chat_completions(request: Request):
             f"Model '{model_id}' not configured. Available: {list(MODELS.keys())}",
         )
 
-    endpoint = model_cfg["endpoint"]
+    foundry_url = model_cfg.get("_url")
+    if not foundry_url:
+        raise HTTPException(500, f"Model '{model_id}' has no endpoint configured")
+
     deployment = model_cfg.get("deployment", model_id)
     should_filter = model_cfg.get("strip_think_tags", True)
     max_tokens_default = model_cfg.get("max_tokens_default", 4096)
@@ -289,22 +415,23 @@ async def chat_completions(request: Request):
         "Content-Type": "application/json",
     }
 
-    foundry_url = f"{endpoint.rstrip('/')}/chat/completions"
     logger.info(
         f"Routing to {foundry_url} | model={deployment} | stream={wants_stream}"
     )
 
+    client = request.app.state.http
     if wants_stream:
         return await _handle_streaming(
-            foundry_url, headers, foundry_body, model_id, should_filter
+            client, foundry_url, headers, foundry_body, model_id, should_filter
         )
     else:
         return await _handle_non_streaming(
-            foundry_url, headers, foundry_body, model_id, should_filter
+            client, foundry_url, headers, foundry_body, model_id, should_filter
         )
 
 
 async def _handle_non_streaming(
+    client: httpx.AsyncClient,
     url: str,
     headers: dict,
     body: dict,
@@ -312,14 +439,13 @@ async def _handle_non_streaming(
     should_filter: bool,
 ) -> JSONResponse:
     """Non-streaming: call Foundry, filter, return."""
-    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-        try:
-            resp = await client.post(url, json=body, headers=headers)
-        except httpx.TimeoutException:
-            raise HTTPException(504, "Foundry request timed out")
-        except httpx.RequestError as e:
-            logger.error(f"Foundry request failed: {e}")
-            raise HTTPException(502, f"Foundry request failed: {e}")
+    try:
+        resp = await client.post(url, json=body, headers=headers)
+    except httpx.TimeoutException:
+        raise HTTPException(504, "Foundry request timed out")
+    except httpx.RequestError as e:
+        logger.error(f"Foundry request failed: {e}")
+        raise HTTPException(502, f"Foundry request failed: {e}")
 
     if resp.status_code != 200:
         logger.error(f"Foundry returned {resp.status_code}: {resp.text[:500]}")
@@ -337,6 +463,7 @@ async def _handle_non_streaming(
 
 
 async def _handle_streaming(
+    client: httpx.AsyncClient,
     url: str,
     headers: dict,
     body: dict,
@@ -348,90 +475,90 @@ async def _handle_streaming(
     async def generate():
         think_filter = StreamingThinkFilter() if should_filter else None
 
-        async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
-            try:
-                async with client.stream(
-                    "POST", url, json=body, headers=headers
-                ) as resp:
-                    if resp.status_code != 200:
-                        error_body = await resp.aread()
-                        logger.error(
-                            f"Foundry stream error {resp.status_code}: "
-                            f"{error_body[:500]}"
-                        )
-                        # Send error as SSE
-                        error_data = {
-                            "error": {
-                                "message": f"Foundry returned {resp.status_code}",
-                                "type": "upstream_error",
-                            }
+        try:
+            async with client.stream(
+                "POST", url, json=body, headers=headers
+            ) as resp:
+                if resp.status_code != 200:
+                    error_body = await resp.aread()
+                    logger.error(
+                        f"Foundry stream error {resp.status_code}: "
+                        f"{error_body[:500]}"
+                    )
+                    # Send error as SSE
+                    error_data = {
+                        "error": {
+                            "message": f"Foundry returned {resp.status_code}",
+                            "type": "upstream_error",
                         }
-                        yield f"data: {json.dumps(error_data)}\n\n"
-                        yield "data: [DONE]\n\n"
-                        return
+                    }
+                    yield _sse_frame(error_data)
+                    yield _SSE_DONE
+                    return
 
-                    async for line in resp.aiter_lines():
-                        if not line.startswith("data: "):
-                            continue
-
-                        payload = line[6:]
-                        if payload.strip() == "[DONE]":
-                            # Flush any remaining buffer
-                            if think_filter:
-                                remaining = think_filter.flush()
-                                if remaining:
-                                    done_chunk = _make_sse_chunk(
-                                        remaining, model_id
-                                    )
-                                    yield f"data: {json.dumps(done_chunk)}\n\n"
-                            yield "data: [DONE]\n\n"
-                            return
-
-                        try:
-                            chunk = json.loads(payload)
-                        except json.JSONDecodeError:
-                            continue
-
-                        # Extract delta content
-                        delta = (
-                            chunk.get("choices", [{}])[0]
-                            .get("delta", {})
-                            .get("content", "")
-                        )
-
-                        if not delta:
-                            # Forward non-content chunks (role, finish_reason, etc.)
-                            yield f"data: {json.dumps(chunk)}\n\n"
-                            continue
+                async for line in _aiter_sse_lines(resp):
+                    if not line.startswith(b"data: "):
+                        continue
 
+                    payload = line[6:]
+                    if payload.strip() == b"[DONE]":
+                        # Flush any remaining buffer
                         if think_filter:
-                            filtered = think_filter.process_text(delta)
-                            if filtered:
-                                chunk["choices"][0]["delta"]["content"] = filtered
-                                yield f"data: {json.dumps(chunk)}\n\n"
-                            # If filtered is empty, we swallowed think content — don't yield
-                        else:
-                            yield f"data: {json.dumps(chunk)}\n\n"
-
-            except httpx.TimeoutException:
-                error_data = {
-                    "error": {
-                        "message": "Foundry request timed out",
-                        "type": "timeout",
-                    }
+                            remaining = think_filter.flush()
+                            if remaining:
+                                done_chunk = _make_sse_chunk(
+                                    remaining, model_id
+                                )
+                                yield _sse_frame(done_chunk)
+                        yield _SSE_DONE
+                        return
+
+                    if (
+                        think_filter is None
+                        or b'"content"' not in payload
+                        or think_filter.passes_through(payload)
+                    ):
+                        # Nothing to filter — forward the upstream frame verbatim
+                        yield line + b"\n\n"
+                        continue
+
+                    try:
+                        chunk = _json_loads(payload)
+                    except json.JSONDecodeError:
+                        continue
+
+                    delta = _delta_content(chunk)
+
+                    if not delta:
+                        # Forward non-content chunks (role, finish_reason, etc.)
+                        yield line + b"\n\n"
+                        continue
+
+                    filtered = think_filter.process_text(delta)
+                    if filtered:
+                        chunk["choices"][0]["delta"]["content"] = filtered
+                        yield _sse_frame(chunk)
+                    # If filtered is empty, we swallowed think content — don't yield
+
+        except httpx.TimeoutException:
+            error_data = {
+                "error": {
+                    "message": "Foundry request timed out",
+                    "type": "timeout",
                 }
-                yield f"data: {json.dumps(error_data)}\n\n"
-                yield "data: [DONE]\n\n"
-            except httpx.RequestError as e:
-                logger.error(f"Stream connection error: {e}")
-                error_data = {
-                    "error": {
-                        "message": f"Connection error: {e}",
-                        "type": "connection_error",
-                    }
+            }
+            yield _sse_frame(error_data)
+            yield _SSE_DONE
+        except httpx.RequestError as e:
+            logger.error(f"Stream connection error: {e}")
+            error_data = {
+                "error": {
+                    "message": f"Connection error: {e}",
+                    "type": "connection_error",
                 }
-                yield f"data: {json.dumps(error_data)}\n\n"
-                yield "data: [DONE]\n\n"
+            }
+            yield _sse_frame(error_data)
+            yield _SSE_DONE
 
     return StreamingResponse(
         generate(),
@@ -444,6 +571,35 @@ async def _handle_streaming(
     )
 
 
+_SSE_DONE = b"data: [DONE]\n\n"
+
+
+async def _aiter_sse_lines(resp: httpx.Response):
+    """Yield upstream SSE lines as raw bytes, without decoding to str."""
+    buf = bytearray()
+    async for data in resp.aiter_bytes():
+        buf += data
+        while (nl := buf.find(b"\n")) != -1:
+            line = bytes(buf[:nl]).rstrip(b"\r")
+            del buf[: nl + 1]
+            yield line
+    if buf:
+        yield bytes(buf).rstrip(b"\r")
+
+
+def _sse_frame(obj) -> bytes:
+    """Serialize an object as a single SSE data frame."""
+    return b"data: " + _json_dumps(obj) + b"\n\n"
+
+
+def _delta_content(chunk: dict) -> str:
+    """Extract choices[0].delta.content from a stream chunk, or ""."""
+    try:
+        return chunk["choices"][0]["delta"]["content"] or ""
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+
 def _make_sse_chunk(content: str, model_id: str) -> dict:
     """Build a minimal SSE chunk for injected content."""
     return {